@@ -10,95 +10,62 @@ import hashlib
 import json
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-import math
+import mmap
 import struct
+import warnings
+import numpy as np
+
+ET.register_namespace('', "http://nfdi4culture.de/stl-metadata-extractor1") # Register default namespace
 
 SUCCESS_CODE = 0
 ERROR_CODE = 1
 DEBUG = 1
+# Layout of a binary STL facet record: normal vector, three vertices, attribute byte count
+BINARY_FACET_DTYPE = np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)), ('attribute_byte_count', '<u2')])
+ASCII_FACET_TOKEN_COUNT = 21 # facet normal x y z outer loop 3*(vertex x y z) endloop endfacet
+ASCII_FACET_KEYWORDS = ((0, b'facet'), (1, b'normal'), (5, b'outer'), (6, b'loop'), (7, b'vertex'), (11, b'vertex'), (15, b'vertex'), (19, b'endloop'), (20, b'endfacet'))
+ASCII_CHUNK_SIZE = 1 << 20 # Number of bytes of an ASCII STL file tokenized at once
+FACET_BLOCK_SIZE = 65536 # Number of facets validated at once before checking for an early exit
+NON_PRINTABLE_CHARACTERS = re.compile(r'[^\x20-\x7E]')
 
 ######################## GEOMETRY FUNCTIONS ########################
 
-def dot_product(v1, v2):
-    return sum(x * y for x, y in zip(v1, v2))
-
-def cross_product(v1, v2):
-    return [
-        v1[1] * v2[2] - v1[2] * v2[1],
-        v1[2] * v2[0] - v1[0] * v2[2],
-        v1[0] * v2[1] - v1[1] * v2[0]
-    ]
-
-def vector_magnitude(v):
-    return math.sqrt(sum(x ** 2 for x in v))
-
-def normalize_vector(v):
-    magnitude = vector_magnitude(v)
-    if magnitude == 0:
-        return [0, 0, 0]
-    return [x / magnitude for x in v]
-
-def are_vectors_close(v1, v2, tol=1e-9):
-    return all(abs(a - b) <= tol for a, b in zip(v1, v2))
-
-# def is_facet_oriented_correctly(vertex1, vertex2, vertex3, normal):
-#     edge1 = [v2 - v1 for v1, v2 in zip(vertex1, vertex2)]
-#     edge2 = [v3 - v1 for v1, v3 in zip(vertex1, vertex3)]
-#     calculated_normal = normalize_vector(cross_product(edge1, edge2))
-#     normal = normalize_vector(normal)
-#     return are_vectors_close(calculated_normal, normal)
-
-# def ensure_counterclockwise(vertex1, vertex2, vertex3, normal):
-#     edge1 = [v2 - v1 for v1, v2 in zip(vertex1, vertex2)]
-#     edge2 = [v3 - v1 for v1, v3 in zip(vertex1, vertex3)]
-#     calculated_normal = cross_product(edge1, edge2)
-#     if dot_product(calculated_normal, normal) < 0:
-#         vertex2, vertex3 = vertex3, vertex2
-#     return vertex1, vertex2, vertex3
-
-def is_counterclockwise(vertex1, vertex2, vertex3, normal):
-    edge1 = [v2 - v1 for v1, v2 in zip(vertex1, vertex2)]
-    edge2 = [v3 - v1 for v1, v3 in zip(vertex1, vertex3)]
-    calculated_normal = cross_product(edge1, edge2)
-    return dot_product(calculated_normal, normal) > 0
+def are_facets_counterclockwise(vertices, normals):
+    # Check whether the vertices of all (N, 3, 3) facets are ordered counterclockwise.
+    calculated_normals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+    return bool((np.einsum('ij,ij->i', calculated_normals, normals) > 0).all())
+
+def validate_facets(vertices, normals):
+    # Check the vertice coordinates in a single reduction and the orientation block by block, stopping at the first clockwise block.
+    has_valid_positive_vertice_coordinates = not (vertices < 0).any()
+    has_valid_counterclockwise_vertices = all(
+        are_facets_counterclockwise(vertices[start:start + FACET_BLOCK_SIZE], normals[start:start + FACET_BLOCK_SIZE])
+        for start in range(0, len(vertices), FACET_BLOCK_SIZE)
+    )
+    return has_valid_counterclockwise_vertices, has_valid_positive_vertice_coordinates
 
 ######################## STL FUNCTIONS ########################
 
-def is_binary_stl(file_path):
+def is_binary_stl(stl_data):
     # Check if the STL file is binary or ASCII.
-    with open(file_path, 'rb') as file:
-        file_size = os.path.getsize(file_path)
-        file.read(80).decode('ascii', errors='ignore')
-        try:
-            triangle_count = struct.unpack('<I', file.read(4))[0]
-        except struct.error:
-            return False
-        return 80 + 4 + 50 * triangle_count == file_size
-
-def extract_binary_stl_metadata(file_path):
+    file_size = len(stl_data)
+    # A binary STL consists of an 80 byte header, a 4 byte triangle count and 50 bytes per triangle.
+    if file_size < 84 or (file_size - 84) % BINARY_FACET_DTYPE.itemsize != 0:
+        return False
+    triangle_count = struct.unpack_from('<I', stl_data, 80)[0]
+    return 84 + BINARY_FACET_DTYPE.itemsize * triangle_count == file_size
+
+def extract_binary_stl_metadata(stl_data):
     # Extract metadata from a binary STL file.
-    with open(file_path, 'rb') as file:
-        header = file.read(80).decode('ascii', errors='ignore').strip()
-        solid_name = re.sub(r'[^\x20-\x7E]', '', header)
-        triangle_count = struct.unpack('<I', file.read(4))[0]
-        has_valid_positive_vertice_coordinates = True
-        has_valid_counterclockwise_vertices = True
-
-        for _ in range(triangle_count):
-            data = struct.unpack('<12fH', file.read(50)) # Normal vector (3 floats), vertices (9 floats), attribute byte count
-            normal = data[0:3]
-            vertex1 = data[3:6]
-            vertex2 = data[6:9]
-            vertex3 = data[9:12]
-            vertices = data[3:12] # Skip normal vector
-            if not is_counterclockwise(vertex1, vertex2, vertex3, normal):
-                has_valid_counterclockwise_vertices = False
-            if any(v < 0 for v in vertices):
-                has_valid_positive_vertice_coordinates = False
+    header = stl_data[:80].decode('ascii', errors='ignore').strip()
+    solid_name = NON_PRINTABLE_CHARACTERS.sub('', header)
+    triangle_count = struct.unpack_from('<I', stl_data, 80)[0]
+    facets = np.frombuffer(stl_data, dtype=BINARY_FACET_DTYPE, count=triangle_count, offset=84)
+
+    has_valid_counterclockwise_vertices, has_valid_positive_vertice_coordinates = validate_facets(facets['vertices'], facets['normal'])
 
     return {
         "solid_name": solid_name,
@@ -107,33 +74,96 @@ def extract_binary_stl_metadata(file_path):
         "has_valid_counterclockwise_vertices": has_valid_counterclockwise_vertices
     }
 
-def extract_ascii_stl_metadata(file_path):
+def find_tokens(data):
+    # Return the start and end offsets of all whitespace separated tokens in a uint8 array.
+    is_space = (data == 32) | ((data >= 9) & (data <= 13))
+    boundaries = np.flatnonzero(is_space[1:] != is_space[:-1]) + 1
+    if not is_space[0]:
+        boundaries = np.concatenate(([0], boundaries))
+    if not is_space[-1]:
+        boundaries = np.concatenate((boundaries, [len(data)]))
+    return boundaries[0::2], boundaries[1::2]
+
+def parse_ascii_facets(stl_data, start, end):
+    # Parse the facets between the given byte offsets chunk by chunk into an (N, 12) float32 array of normals and vertices.
+    # Keywords are checked by their fixed token offset within a facet and then blanked out, so that the
+    # remaining text consists of the coordinates only and can be parsed by NumPy without per-token objects.
+    # The coordinates are written into one preallocated array, sized by extrapolating the coordinates per byte seen so far.
+    coordinates = np.empty(0, dtype=np.float32)
+    coordinate_total = 0
+    range_start = start
+    token_count = 0
+    while start < end:
+        chunk_end = min(start + ASCII_CHUNK_SIZE, end)
+        while chunk_end < end and not stl_data[chunk_end:chunk_end + 1].isspace(): # Do not split tokens
+            chunk_end += 1
+        data = np.frombuffer(stl_data, dtype=np.uint8, count=chunk_end - start, offset=start).copy()
+        token_starts, token_ends = find_tokens(data)
+        token_offsets = np.arange(token_count, token_count + len(token_starts)) % ASCII_FACET_TOKEN_COUNT
+        coordinate_count = len(token_starts)
+        for offset, keyword in ASCII_FACET_KEYWORDS:
+            keyword_starts = token_starts[token_offsets == offset]
+            keyword_ends = token_ends[token_offsets == offset]
+            has_keyword_lengths = ((keyword_ends - keyword_starts) == len(keyword)).all()
+            # Setting bit 0x20 lowercases ASCII letters, so keywords are compared case-insensitively
+            has_keyword_characters = has_keyword_lengths and all(
+                ((data[keyword_starts + i] | 0x20) == character).all() for i, character in enumerate(keyword)
+            )
+            if not has_keyword_characters:
+                print_error(f"Expected '{keyword.decode()}' in every facet.")
+            for i in range(len(keyword)):
+                data[keyword_starts + i] = 32
+            coordinate_count -= len(keyword_starts)
+        if coordinate_count: # NumPy parses text without any number as [-1]
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('error') # Older NumPy versions only warn about unparsable text
+                    chunk_coordinates = np.fromstring(data.tobytes(), sep=' ', dtype=np.float32)
+            except (ValueError, DeprecationWarning):
+                chunk_coordinates = None
+            if chunk_coordinates is None or len(chunk_coordinates) != coordinate_count:
+                print_error("Invalid facet coordinates.")
+            if coordinate_total + coordinate_count > len(coordinates):
+                capacity = (coordinate_total + coordinate_count) * (end - range_start) // (chunk_end - range_start)
+                grown_coordinates = np.empty(capacity + capacity // 16, dtype=np.float32)
+                grown_coordinates[:coordinate_total] = coordinates[:coordinate_total]
+                coordinates = grown_coordinates
+            coordinates[coordinate_total:coordinate_total + coordinate_count] = chunk_coordinates
+            coordinate_total += coordinate_count
+        token_count += len(token_starts)
+        start = chunk_end
+
+    facet_count, remaining_token_count = divmod(token_count, ASCII_FACET_TOKEN_COUNT)
+    if remaining_token_count:
+        print_error(f"Facets consist of {token_count} tokens, which is not a multiple of {ASCII_FACET_TOKEN_COUNT}.")
+    return coordinates[:facet_count * 12].reshape(facet_count, 12)
+
+def extract_ascii_stl_metadata(stl_data):
     # Extract metadata from an ascii STL file.
-    with open(file_path, 'r') as file:
-        lines = [re.sub(r'\s+', ' ' , line.strip()) for line in file.readlines() if line.strip()]
-    
-    if not lines[0].startswith("solid"):
+    stl_data.seek(0)
+    header = stl_data.readline()
+    while header and header.isspace():
+        header = stl_data.readline()
+    header = b' '.join(header.split()).decode('utf-8', errors='ignore')
+    if not header.lower().startswith("solid"):
         print_error("File does not start with 'solid'.")
 
-    solid_name = str(lines[0][6:]).lstrip()
-    total_facet_count = (len(lines) - 2) // 7
-    has_valid_positive_vertice_coordinates = True
-    # has_valid_facet_normals = True
-    has_valid_counterclockwise_vertices = True
-
-    for i in range(total_facet_count):
-        y = i * 7 + 1
-        normal = list(map(float, lines[y].split()[2:]))
-        vertices = []
-        for j in range(3):
-            vertex = list(map(float, lines[y + 2 + j].split()[1:]))
-            if any(coord < 0 for coord in vertex):
-                has_valid_positive_vertice_coordinates = False
-            vertices.append(vertex)
-        # if not is_facet_oriented_correctly(vertices[0], vertices[1], vertices[2], normal):
-        #     has_valid_facet_normals = False
-        if not is_counterclockwise(vertices[0], vertices[1], vertices[2], normal):
-            has_valid_counterclockwise_vertices = False
+    # The last non-empty line holds 'endsolid' followed by the optional solid name
+    body_start = stl_data.tell()
+    body_end = len(stl_data)
+    while body_end > body_start and stl_data[body_end - 1:body_end].isspace():
+        body_end -= 1
+    last_line_start = max(stl_data.rfind(b'\n', body_start, body_end) + 1, body_start)
+    if stl_data[last_line_start:body_end].lower().split()[:1] != [b'endsolid']:
+        print_error("File does not end with 'endsolid'.")
+    facet_coordinates = parse_ascii_facets(stl_data, body_start, last_line_start)
+
+    solid_name = header[6:].lstrip()
+    total_facet_count = len(facet_coordinates)
+    normals = facet_coordinates[:, :3]
+    vertices = facet_coordinates[:, 3:].reshape(total_facet_count, 3, 3)
+
+    has_valid_counterclockwise_vertices, has_valid_positive_vertice_coordinates = validate_facets(vertices, normals)
 
     return {
         "solid_name": solid_name,
@@ -150,12 +180,8 @@ def get_target_file_name_from_arguments():
             return arg.split("=", 1)[1]
     return None
 
-def calculate_checksum(file_path, algorithm='sha256'):
-    hash_func = hashlib.new(algorithm)
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            hash_func.update(chunk)
-    return hash_func.hexdigest()
+def calculate_checksum(data, algorithm='sha256'):
+    return hashlib.new(algorithm, data).hexdigest()
 
 def print_warning(message):
     if DEBUG:
@@ -175,26 +201,26 @@ class STLValidatorException(Exception):
 def extract_stl_metadata(file_path):
     # Main function to extract STL metadata.
     try:
-        if is_binary_stl(file_path):
-            metadata = extract_binary_stl_metadata(file_path)
-            format_version = 'binary'
-        else:
-            metadata = extract_ascii_stl_metadata(file_path)
-            format_version = 'ASCII'
-
-        file_size = os.path.getsize(file_path)
-        checksum = calculate_checksum(file_path)
-        creation_date = datetime.utcfromtimestamp(os.path.getctime(file_path)).isoformat()
-        modification_date = datetime.utcfromtimestamp(os.path.getmtime(file_path)).isoformat()
+        with open(file_path, 'rb') as file:
+            file_stat = os.fstat(file.fileno())
+            if file_stat.st_size == 0: # Empty files cannot be memory-mapped
+                print_error("File is empty.")
+            # Map the file once so that parsing and hashing share the same pages
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as stl_data:
+                if is_binary_stl(stl_data):
+                    metadata = extract_binary_stl_metadata(stl_data)
+                    format_version = 'binary'
+                else:
+                    metadata = extract_ascii_stl_metadata(stl_data)
+                    format_version = 'ASCII'
+                checksum = calculate_checksum(stl_data)
 
         # File metadata
-        file_size = os.path.getsize(file_path)
-        creation_date = datetime.utcfromtimestamp(os.path.getctime(file_path)).isoformat()
-        modification_date = datetime.utcfromtimestamp(os.path.getmtime(file_path)).isoformat()
-        checksum = calculate_checksum(file_path)
+        file_size = file_stat.st_size
+        creation_date = datetime.fromtimestamp(file_stat.st_ctime, tz=timezone.utc).isoformat()
+        modification_date = datetime.fromtimestamp(file_stat.st_mtime, tz=timezone.utc).isoformat()
 
         # Create XML tree with namespace and schema location
-        ET.register_namespace('', "http://nfdi4culture.de/stl-metadata-extractor1") # Register default namespace
         root = ET.Element('STLMetadataExtractor', {
             'xmlns': "http://nfdi4culture.de/stl-metadata-extractor1",
             'xmlns:xsi': "http://www.w3.org/2001/XMLSchema-instance",
@@ -216,12 +242,10 @@ def extract_stl_metadata(file_path):
         # ET.SubElement(root, 'hasValidFacetNormals').text = str(has_valid_facet_normals).lower()
         ET.SubElement(root, 'hasValidPositiveVerticeCoordinates').text = str(metadata["has_valid_positive_vertice_coordinates"]).lower()
 
-        # Convert ElementTree to minidom document for CDATA support
-        xml_str = ET.tostring(root, encoding='utf-8')
-        dom = minidom.parseString(xml_str)
-        
-        # Print formatted XML with CDATA
-        print(dom.toprettyxml(indent="    "))
+        # Print formatted XML
+        ET.indent(root, space="    ")
+        print('<?xml version="1.0" ?>')
+        print(ET.tostring(root, encoding='unicode'))
         return SUCCESS_CODE
 
     except STLValidatorException as e: